@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Reduce the visa_data.ndjson checkpoint stream into a single visa_data.json
+dict for consumers that want the aggregate form (e.g. the Sanity import).
+"""
+
+import json
+import sys
+
+
+def main():
+    input_file = sys.argv[1] if len(sys.argv) > 1 else "visa_data.ndjson"
+    output_file = sys.argv[2] if len(sys.argv) > 2 else "visa_data.json"
+
+    results = {}
+    with open(input_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                results[record["key"]] = record["data"]
+            except (json.JSONDecodeError, KeyError):
+                continue  # Skip lines truncated by a crash
+
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+    print(f"📊 Wrote {len(results)} countries from {input_file} to {output_file}")
+
+
+if __name__ == "__main__":
+    main()